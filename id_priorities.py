@@ -3,8 +3,21 @@
 import argparse
 import pandas as pd
 import os.path
+import io
 import yaml
 
+# The only columns of the iNat observation export used to find priority observations.
+OBSERVATION_COLUMNS = ['url', 'image_url', 'quality_grade', 'taxon_kingdom_name', 'taxon_class_name', 'taxon_order_name', 'taxon_family_name', 'taxon_genus_name', 'taxon_species_name']
+# Heavily repeated string columns are loaded as categoricals.
+OBSERVATION_DTYPES = {
+	'quality_grade': 'category',
+	'taxon_kingdom_name': 'category',
+	'taxon_class_name': 'category',
+	'taxon_order_name': 'category',
+	'taxon_family_name': 'category',
+	'taxon_genus_name': 'category',
+}
+
 if __name__ == '__main__':
 	parser = argparse.ArgumentParser(description='Find observations IDed to genus level for which there are no species-level IDs, i.e. observations which, if they were IDed to species level, are guaranteed to be species not yet present in the set.')
 	parser.add_argument('analysis')
@@ -12,7 +25,7 @@ if __name__ == '__main__':
 	
 	config = yaml.safe_load(open(os.path.join('data', args.analysis, 'config.yaml')))
 	root_h_lvl = int(config.get('root_header_level', 1))
-	df = pd.read_csv(os.path.join('data', args.analysis, config['file']))
+	df = pd.read_csv(os.path.join('data', args.analysis, config['file']), usecols=OBSERVATION_COLUMNS, dtype=OBSERVATION_DTYPES)
 	
 	try:
 		os.mkdir(os.path.join('data', args.analysis, 'output'))
@@ -24,10 +37,11 @@ if __name__ == '__main__':
 		pass
 	
 	# Genuses of any observation not IDed to species level has potential.
-	potential_genuses = list(df.loc[pd.isnull(df.taxon_species_name), 'taxon_genus_name'].value_counts().index)
+	potential_genuses = list(df.loc[pd.isnull(df.taxon_species_name), 'taxon_genus_name'].dropna().unique())
 	
 	# Whittle that list down to those for which no observations are IDed to species
-	speciesless_genuses = [g for g in potential_genuses if not df.loc[df.taxon_genus_name == g, 'taxon_species_name'].any()]
+	genus_has_species = df.assign(has_species=df.taxon_species_name.notna()).groupby('taxon_genus_name', observed=True)['has_species'].any()
+	speciesless_genuses = [g for g in potential_genuses if not genus_has_species[g]]
 	
 	# List all observations in those genuses which have not been marked as impossible to improve
 	priority_obs = df.loc[df.taxon_genus_name.isin(speciesless_genuses) & (df.quality_grade != 'research')]
@@ -36,16 +50,17 @@ if __name__ == '__main__':
 	priority_obs = priority_obs.sort_values(['taxon_kingdom_name', 'taxon_class_name', 'taxon_order_name', 'taxon_family_name', 'taxon_genus_name'])
 	
 	# Create thumbnail image URL column
-	priority_obs.loc[:, 'image_url_smol'] = priority_obs.image_url.str.replace('medium.jpeg', 'thumb.jpeg')
+	priority_obs.loc[:, 'image_url_smol'] = priority_obs.image_url.str.replace('medium.jpeg', 'thumb.jpeg', regex=False)
 	
 	# Create basic list for review
-	fp = open(os.path.join('data', args.analysis, 'output', 'current', 'priority.html'), 'w')
+	# Build the list in memory and write it out in one go once finished.
+	f_output = io.StringIO()
 	
-	fp.write(f"<h{root_h_lvl}>Priority Observations</h{root_h_lvl}>")
-	fp.write('<p>The following observations are in genera for which the project currently has no species-level observations, and are therefore likely to be able to increase the species count.</p>')
+	f_output.write(f"<h{root_h_lvl}>Priority Observations</h{root_h_lvl}>")
+	f_output.write('<p>The following observations are in genera for which the project currently has no species-level observations, and are therefore likely to be able to increase the species count.</p>')
 	
 	# Clumsy inline CSS for now.
-	fp.write('''
+	f_output.write('''
 <style>
 body {
 	font-family: Whitney, "Trebuchet MS", Arial, sans-serif;
@@ -76,37 +91,28 @@ body {
 ''')
 	
 	current_kingdom = None
-	current_class = None
-	current_order = None
-	current_family = None
-	in_family_container = False
-	current_genus = None
 	
-	for i, row in priority_obs.iterrows():
-		if row['taxon_kingdom_name'] != current_kingdom:
-			if in_family_container:
-				fp.write('</div>')
-				in_family_container = False
-			fp.write(f'''<h{root_h_lvl+1}>{row['taxon_kingdom_name']}</h{root_h_lvl+1}>''')
+	# Observations are already sorted taxonomically, so each family forms one contiguous group.
+	family_groups = priority_obs.groupby(['taxon_kingdom_name', 'taxon_class_name', 'taxon_order_name', 'taxon_family_name'], sort=False, observed=True, dropna=False)
+	
+	for (kingdom, klass, order, family), family_obs in family_groups:
+		if kingdom != current_kingdom:
+			f_output.write(f'''<h{root_h_lvl+1}>{kingdom}</h{root_h_lvl+1}>''')
 		
-		if row['taxon_family_name'] != current_family:
-			if in_family_container:
-				fp.write('</div>')
-				in_family_container = False
-			fp.write(f'''<h{root_h_lvl+2}>{row['taxon_class_name']} → {row['taxon_order_name']} → {row['taxon_family_name']}</h{root_h_lvl+2}>
+		f_output.write(f'''<h{root_h_lvl+2}>{klass} → {order} → {family}</h{root_h_lvl+2}>
 <div class="family-container">''')
-			in_family_container = True
 		
-		fp.write(f'''<div class="priority-observation">
-<a class="genus" href="{row['url']}">{row['taxon_genus_name']}</a>
-<a href="{row['url']}"><img src="{row['image_url']}" /></a>
+		# Pull the columns needed for output out as plain tuples, avoiding a Series per row.
+		for genus, url, image_url in family_obs.loc[:, ['taxon_genus_name', 'url', 'image_url']].to_numpy():
+			f_output.write(f'''<div class="priority-observation">
+<a class="genus" href="{url}">{genus}</a>
+<a href="{url}"><img src="{image_url}" /></a>
 </div>
 ''')
 		
-		current_kingdom = row['taxon_kingdom_name']
-		current_class = row['taxon_class_name']
-		current_order = row['taxon_order_name']
-		current_family = row['taxon_family_name']
-		current_genus = row['taxon_genus_name']
+		f_output.write('</div>')
+		current_kingdom = kingdom
 	
-	fp.close()
\ No newline at end of file
+	with open(os.path.join('data', args.analysis, 'output', 'current', 'priority.html'), 'w', encoding='utf-8') as fp:
+		fp.write(f_output.getvalue())
+	f_output.close()
\ No newline at end of file
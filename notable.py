@@ -6,14 +6,21 @@ import os.path
 import pandas as pd
 import numpy as np
 import requests
+import requests.adapters
+import urllib3.util
 import time
 import datetime
 import urllib.parse
 import yaml
-import IPython
-import hashlib
-import json
+import sqlite3
+import orjson
 import html
+import functools
+import operator
+import io
+import math
+import threading
+import concurrent.futures
 
 DESCRIPTION = """
 Given a config file with information about a project (example in data/example/config.yaml) and an
@@ -48,55 +55,239 @@ Source: https://github.com/barnabywalters/inaturalist-project-stats
 By Barnaby Walters (waterpigs.co.uk)
 """
 
-def fetch_all_results(api_url, delay=1.0, ttl=(60 * 60 * 24), cache_location=None):
-	total_results = None
-	results = []
-	page = 1
-	cache_path = None
-	fetched_from_cache = False
-	while (total_results is None) or len(results) < total_results:
-		req_url = f"{api_url}&page={page}&ttl={ttl}"
-		
-		try:
-			if cache_location is None:
-				raise Exception()
-			cache_path = os.path.join(cache_location, f"{hashlib.md5(req_url.encode('utf-8')).hexdigest()}.json")
-			with open(cache_path, encoding='utf-8') as fp:
-				jresp = json.load(fp)
-				fetched_from_cache = True
-				print('c', end='', flush=True)
-		except:
-			resp = requests.get(req_url)
-			resp.raise_for_status()
-			fetched_from_cache = False
-			jresp = resp.json()
-			#print(req_url)
-			print('.', end='', flush=True)
-			
-			if cache_path is not None:
-				with open(cache_path, 'w', encoding='utf-8') as fp:
-					json.dump(jresp, fp)
-			
-		if total_results is None:
-			total_results = jresp['total_results']
+# The only columns of the iNat observation export used in the analysis. Any others are skipped when loading it.
+OBSERVATION_COLUMNS = ['id', 'taxon_id', 'taxon_species_name', 'scientific_name', 'common_name', 'species_guess', 'user_login', 'quality_grade', 'time_observed_at', 'image_url']
+# Heavily repeated string columns are loaded as categoricals. common_name and species_guess stay as plain strings, as
+# they end up in species columns which get overwritten with names fetched from the API.
+OBSERVATION_DTYPES = {
+	'user_login': 'category',
+	'quality_grade': 'category',
+	'scientific_name': 'category',
+	'taxon_species_name': 'category',
+}
+
+# Only request the species_counts fields used in the analysis, which keeps responses (and the cache) much smaller.
+SPECIES_COUNTS_FIELDS = urllib.parse.quote('(count:!t,taxon:(id:!t,observations_count:!t,preferred_common_name:!t))', safe='')
+
+# Filter JS hard-coded here for now.
+FILTER_JS = """
+<script>
+(function () {
+    var searchInput = document.querySelector('.filter-observations input');
+    searchInput.addEventListener('keyup', function (event) {
+        document.querySelectorAll('.filterable').forEach(function (el) {
+            if (el.innerText.search(searchInput.value) != -1) {
+                el.style.display = '';
+            } else {
+                el.style.display = 'none';
+            }
+        });
+    });
+}());
+</script>
+"""
+
+# CSS hard-coded here for now.
+STYLES = """
+<style>
+
+body {
+	font-family: Whitney, "Trebuchet MS", Arial, sans-serif;
+}
+
+.observations-container {
+	display: flex;
+	flex-wrap: wrap;
+	list-style: none;
+}
+
+.observation {
+	margin: 0 0.5em 0.5em 0;
+	padding: 0.5em;
+	background-color: #f1f1f1;
+	max-width: 12em;
+	text-align: center;
+}
+
+.observation .name {
+	display: block;
+	margin-bottom: 0.5em;
+	text-align: center;
+}
+
+.observation img {
+	display: block;
+	height: 10em;
+	max-width: 100%;
+	margin: 0 auto;
+}
+</style>
+"""
+
+# Report list items, filled in with str.format.
+FIRST_OBSERVATION_TEMPLATE = """<li class="observation filterable"><a class="name" href="https://inaturalist.org/taxa/{tid}"><{rg_el}>{name}</{rg_el}></a> <a href="https://www.inaturalist.org/observations/{obs_id}"><img class="observation-thumbnail" src="{image_url}" alt="" /> first observation by @{observer}</a></li>\n"""
+NOTABLE_OBSERVATION_TEMPLATE = """<li class="filterable"><a href="https://inaturalist.org/taxa/{tid}">{name}</a> observed by: {observers} (<a href="{obs_url}">{count} total</a>)</li>\n"""
+NOTABLE_OBSERVER_TEMPLATE = """<a href="https://www.inaturalist.org/observations?user_id={observer}&taxon_id={tid}&{context_query}">@{observer}</a>"""
+
+# Table of contents entry for each place, filled in with str.format.
+TOC_PLACE_TEMPLATE = """
+						<li>
+                <a href="#{col}">{name}</a>
+                <ol>
+                    <li><a href="#{col}-firsts">First Observations</a></li>
+                    <li><a href="#{col}-notable">Notable Observations</a></li>
+                </ol>
+            </li>
+						"""
+
+class RateLimiter(object):
+	"""
+	Spaces out calls to `wait` across all threads so that no two proceed less than `delay` seconds apart.
+	"""
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.next_slot = 0.0
+
+	def wait(self, delay):
+		with self.lock:
+			now = time.monotonic()
+			slot = max(now, self.next_slot)
+			self.next_slot = slot + delay
+		if slot > now:
+			time.sleep(slot - now)
+
+# Shared between all fetches so that concurrent requests still respect the iNat API rate limit.
+api_rate_limiter = RateLimiter()
+
+# Shared between all requests so that connections to the iNat API are kept alive and reused. Rate-limited or
+# failed requests are retried with exponential backoff.
+api_session = requests.Session()
+api_session.mount('https://', requests.adapters.HTTPAdapter(
+	pool_connections=4,
+	pool_maxsize=8,
+	max_retries=urllib3.util.Retry(total=5, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504]),
+))
+
+class ResponseCache(object):
+	"""
+	Stores API responses in a single sqlite database in `location`, keyed by request URL.
+	"""
+	def __init__(self, location):
+		self.location = location
+		# One connection is shared between fetch threads, with access serialised by the lock.
+		self.lock = threading.Lock()
+		self.db = sqlite3.connect(os.path.join(location, 'responses.sqlite'), check_same_thread=False)
+		self.db.execute('CREATE TABLE IF NOT EXISTS responses (url TEXT PRIMARY KEY, response BLOB NOT NULL)')
+
+	def get(self, req_url):
+		with self.lock:
+			row = self.db.execute('SELECT response FROM responses WHERE url = ?', (req_url, )).fetchone()
+		if row is not None:
+			return orjson.loads(row[0])
+		return None
+
+	def set(self, req_url, jresp):
+		with self.lock, self.db:
+			self.db.execute('INSERT OR REPLACE INTO responses (url, response) VALUES (?, ?)', (req_url, orjson.dumps(jresp)))
+
+def cached_page(req_url, cache=None):
+	jresp = cache.get(req_url) if cache is not None else None
+	if jresp is not None:
+		print('c', end='', flush=True)
+	return jresp
+
+def fetch_page(req_url, delay=1.0, cache=None):
+	# Only actual requests wait for a slot from the rate limiter, cached responses never get this far.
+	api_rate_limiter.wait(delay)
+	resp = api_session.get(req_url)
+	resp.raise_for_status()
+	jresp = orjson.loads(resp.content)
+	#print(req_url)
+	print('.', end='', flush=True)
+	
+	if cache is not None:
+		cache.set(req_url, jresp)
+	return jresp
+
+def fetch_all_results(api_url, delay=1.0, ttl=(60 * 60 * 24), cache=None, max_workers=4):
+	# Fetch the first page on its own to find out how many pages there are.
+	req_url = f"{api_url}&page=1&ttl={ttl}"
+	jresp = cached_page(req_url, cache=cache)
+	if jresp is None:
+		jresp = fetch_page(req_url, delay=delay, cache=cache)
+	total_results = jresp['total_results']
+	results = list(jresp['results'])
+	per_page = jresp.get('per_page') or len(results)
+	if len(results) >= total_results or per_page == 0:
+		return results
+
+	# Load all remaining pages which are already cached up front, so that re-runs over fully cached data never wait
+	# on the rate limiter. A pool of page fetches is only started if some pages are missing (the chunks themselves
+	# still go through fetch_species_counts’ pool either way).
+	num_pages = math.ceil(total_results / per_page)
+	req_urls = [f"{api_url}&page={page}&ttl={ttl}" for page in range(2, num_pages + 1)]
+	pages = [cached_page(u, cache=cache) for u in req_urls]
+
+	# Then fetch any missing pages concurrently, collecting them in page order.
+	missing = [i for i, jresp in enumerate(pages) if jresp is None]
+	if len(missing) > 0:
+		with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+			for i, jresp in zip(missing, executor.map(lambda i: fetch_page(req_urls[i], delay=delay, cache=cache), missing)):
+				pages[i] = jresp
+	for jresp in pages:
 		results.extend(jresp['results'])
-		page += 1
-		if not fetched_from_cache:
-			time.sleep(delay)
 	return results
 
-def species_name(t, locale='en'):
-	if not pd.isnull(t[f'common_name_{locale}']) and t['scientific_name'] != t[f'common_name_{locale}']:
-		return f"<i>{t['scientific_name']}</i> ({t[f'common_name_{locale}']})"
-	elif not pd.isnull(t['common_name']) and t['scientific_name'] != t['common_name']:
-		return f"<i>{t['scientific_name']}</i> ({t['common_name']})"
+def is_missing(value):
+	# Cheaper than pd.isnull for plain scalars: NaN is the only value which isn’t equal to itself.
+	return value is None or value != value
+
+@functools.lru_cache(maxsize=None)
+def format_species_name(scientific_name, common_name, local_common_name):
+	if not is_missing(local_common_name) and scientific_name != local_common_name:
+		return f"<i>{scientific_name}</i> ({local_common_name})"
+	elif not is_missing(common_name) and scientific_name != common_name:
+		return f"<i>{scientific_name}</i> ({common_name})"
 	else:
-		return f"<i>{t['scientific_name']}</i>"
+		return f"<i>{scientific_name}</i>"
+
+def species_name(t, locale='en'):
+	# Taxa often appear in several sections of the report, so the formatted names are memoised.
+	return format_species_name(t['scientific_name'], t['common_name'], t[f'common_name_{locale}'])
 
 def chunks(l, chunk_size):
 	chunk_size = max(1, chunk_size)
 	return (l[i:i+chunk_size] for i in range(0, len(l), chunk_size))
 
+def fetch_species_counts(taxon_ids, filters='', locale='en', cache=None, chunk_size=500, per_page=500, delay=1.0, max_workers=4):
+	"""
+	Fetches species_counts results for `taxon_ids`, optionally narrowed down by additional `filters` (e.g. a place_id
+	query string), returning a dataframe of counts, global observation counts and common names indexed by taxon ID.
+
+	Requesting as many results per page as species_counts allows means each chunk of taxa usually needs only one
+	request.
+	"""
+	chunk_urls = []
+	for tids in chunks(taxon_ids, chunk_size):
+		# Taxon IDs are plain ints, so the only character needing URL-encoding is the separating comma.
+		ctids = '%2C'.join(map(str, tids))
+		chunk_urls.append(f"https://api.inaturalist.org/v2/observations/species_counts?{filters}&taxon_id={ctids}&rank=species&locale={locale}&per_page={per_page}&fields={SPECIES_COUNTS_FIELDS}")
+
+	# Fetch all chunks concurrently. The shared rate limiter still spaces out the actual requests.
+	results = []
+	with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+		for chunk_results in executor.map(lambda u: fetch_all_results(u, delay=delay, cache=cache), chunk_urls):
+			results.extend(chunk_results)
+
+	# Collect the results into a frame, so they can be assigned to species a column at a time rather than row by row.
+	counts = pd.DataFrame([{
+		'taxon_id': r['taxon']['id'],
+		'count': r['count'],
+		'global_count': r['taxon']['observations_count'],
+		'common_name': r['taxon'].get('preferred_common_name'),
+	} for r in results], columns=['taxon_id', 'count', 'global_count', 'common_name'])
+	return counts.drop_duplicates(subset=['taxon_id'], keep='last').set_index('taxon_id')
+
 if __name__ == "__main__":
 	parser = argparse.ArgumentParser(
 		formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -108,7 +299,7 @@ if __name__ == "__main__":
 	args = parser.parse_args()
 
 	config = yaml.safe_load(open(os.path.join('data', args.analysis, 'config.yaml'), encoding='utf-8'))
-	df = pd.read_csv(os.path.join('data', args.analysis, config['file']), encoding='utf-8')
+	df = pd.read_csv(os.path.join('data', args.analysis, config['file']), encoding='utf-8', usecols=lambda c: c in OBSERVATION_COLUMNS, dtype=OBSERVATION_DTYPES)
 	root_h_lvl = int(config.get('root_header_level', 1))
 	try:
 		os.mkdir(os.path.join('data', args.analysis, 'output'))
@@ -122,6 +313,7 @@ if __name__ == "__main__":
 		os.mkdir(os.path.join('data', '_cache'))
 	except:
 		pass
+	response_cache = ResponseCache(os.path.join('data', '_cache'))
 	
 	# Ensure a context query string exists.
 	if 'context_query' not in config:
@@ -138,7 +330,7 @@ if __name__ == "__main__":
 		# Find the most appropriate display name.
 		if 'name' not in p_config:
 			try:
-				p_result = requests.get(f"https://api.inaturalist.org/v1/places/{p_config['quoted_pids']}").json()['results'][0]
+				p_result = orjson.loads(api_session.get(f"https://api.inaturalist.org/v1/places/{p_config['quoted_pids']}").content)['results'][0]
 			except:
 				p_result = {}
 			p_config['name'] = p_result.get('display_name', str(p_config['id']))
@@ -146,70 +338,18 @@ if __name__ == "__main__":
 	
 	locale = config.get('locale', 'en')
 
-	f_output = open(os.path.join('data', args.analysis, 'output', 'current', 'index.html'), 'w', encoding='utf-8')
+	# Build the report in memory and write it out in one go once finished.
+	f_output = io.StringIO()
 
-	# Filter JS hard-coded here for now.
-	filter_js = """
-<script>
-(function () {
-    var searchInput = document.querySelector('.filter-observations input');
-    searchInput.addEventListener('keyup', function (event) {
-        document.querySelectorAll('.filterable').forEach(function (el) {
-            if (el.innerText.search(searchInput.value) != -1) {
-                el.style.display = '';
-            } else {
-                el.style.display = 'none';
-            }
-        });
-    });
-}());
-</script>
-"""
-	
-	# CSS hard-coded here for now.
-	styles = """
-<style>
-
-body {
-	font-family: Whitney, "Trebuchet MS", Arial, sans-serif;
-}
-
-.observations-container {
-	display: flex;
-	flex-wrap: wrap;
-	list-style: none;
-}
-
-.observation {
-	margin: 0 0.5em 0.5em 0;
-	padding: 0.5em;
-	background-color: #f1f1f1;
-	max-width: 12em;
-	text-align: center;
-}
-
-.observation .name {
-	display: block;
-	margin-bottom: 0.5em;
-	text-align: center;
-}
-
-.observation img {
-	display: block;
-	height: 10em;
-	max-width: 100%;
-	margin: 0 auto;
-}
-</style>
-"""
+	escaped_name = html.escape(config['name'])
 
 	# Explanation text hard-coded here for now.
 	f_output.write(f"""
-<title>{html.escape(config['name'])}</title>
+<title>{escaped_name}</title>
 
-{styles}
+{STYLES}
 								
-<h{root_h_lvl}>{html.escape(config['name'])}</h{root_h_lvl}>
+<h{root_h_lvl}>{escaped_name}</h{root_h_lvl}>
 								
 <p>Last updated: {datetime.datetime.now().strftime('%Y-%m-%d')}</p>
 
@@ -236,17 +376,7 @@ body {
         <ol>"""
 	)
 
-	for place in places:
-		f_output.write(f"""
-						<li>
-                <a href="#{place['col']}">{html.escape(place['name'])}</a>
-                <ol>
-                    <li><a href="#{place['col']}-firsts">First Observations</a></li>
-                    <li><a href="#{place['col']}-notable">Notable Observations</a></li>
-                </ol>
-            </li>
-						"""
-		)
+	f_output.write(''.join([TOC_PLACE_TEMPLATE.format(col=place['col'], name=html.escape(place['name'])) for place in places]))
 
 	f_output.write(f"""
         </ol>
@@ -260,7 +390,7 @@ body {
 <label>Search: <input type="text" />
 </div>
 
-{filter_js}
+{FILTER_JS}
 """)
 
 	unique_observations = {}
@@ -270,65 +400,83 @@ body {
 		df.loc[:, 'quality_grade'] = 'research'
 
 	# Filter out casual observations.
-	df = df.query('quality_grade != "casual"')
+	df = df.loc[df.loc[:, 'quality_grade'] != 'casual', :]
 	
 	# Only include observations with a species-level identification.
 	df = df.dropna(subset=['taxon_species_name'])
 
+	# Every remaining observation has a taxon, so taxon IDs can be downcast to the smallest integer type which holds
+	# them, making the many groupbys on them cheaper.
+	df = df.assign(taxon_id=pd.to_numeric(df.loc[:, 'taxon_id'], downcast='integer'))
+
 	# Create thumbnail image URL column
-	df.loc[:, 'image_url_smol'] = df.image_url.str.replace('medium.jpeg', 'thumb.jpeg')
+	df.loc[:, 'image_url_smol'] = df.image_url.str.replace('medium.jpeg', 'thumb.jpeg', regex=False)
 
 	# Create a local species reference from the dataframe.
-	species = df.loc[:, ('taxon_id', 'scientific_name', 'common_name', 'species_guess')].drop_duplicates(subset=['taxon_id'])
-	# iNat export common_name is in english, at least for me.
-	species.loc[:, 'common_name_en'] = species.loc[:, 'common_name']
-	# species_guess is usually in the locale we want for some reason, so use that instead of common name.
-	species.loc[:, 'common_name'] = species.loc[:, 'species_guess']
-	species = species.set_index(species.loc[:, 'taxon_id'])
-	species.loc[:, 'uniquely_observed'] = False
-	species.loc[:, 'global_observation_count'] = np.nan
-	species.loc[:, 'project_observation_count'] = np.nan
-	# Other place observation counts follow pattern {place_id}_observation_count
-	species.loc[:, 'notable_sort_order'] = np.nan
-	species.loc[:, 'notable'] = False
+	species = df.loc[:, ('taxon_id', 'scientific_name', 'common_name', 'species_guess')].drop_duplicates(subset=['taxon_id']).set_index('taxon_id', drop=False)
+	# Add all analysis columns in one go rather than one at a time.
+	analysis_cols = {
+		# species_guess is usually in the locale we want for some reason, so use that instead of common name.
+		'common_name': species.loc[:, 'species_guess'],
+		# iNat export common_name is in english, at least for me.
+		'common_name_en': species.loc[:, 'common_name'],
+		'uniquely_observed': False,
+		'global_observation_count': np.nan,
+		'project_observation_count': np.nan,
+		# Other place observation counts follow pattern {place_id}_observation_count
+		'notable_sort_order': np.nan,
+		'notable': False,
+	}
 	if config.get('locale') and config['locale'] != 'en':
-		species.loc[:, f"common_name_{config['locale']}"] = np.nan
+		analysis_cols[f"common_name_{config['locale']}"] = None
+	species = species.assign(**analysis_cols)
 	
 	notable_species = []
 
+	# Filter RG observations once, for reuse by everything which only considers RG observations.
+	rg_df = df.loc[df.loc[:, 'quality_grade'] == 'research', :]
+
 	# Perform unique observation analysis.
-	for tid in species.index:
-		observers = df.query('taxon_id == @tid').loc[:, 'user_login'].drop_duplicates()
-		research_grade_observers = df.query('taxon_id == @tid and quality_grade == "research"').loc[:, 'user_login'].drop_duplicates()
-
-		species.loc[tid, 'project_observation_count'] = observers.shape[0]
-
-		if observers.shape[0] == 1:
-			# Only one person made any observations of this species.
-			observer = observers.squeeze()
-			if observer not in unique_observations:
-				unique_observations[observer] = []
-
-			species.loc[tid, 'uniquely_observed'] = True
-
-			unique_observations[observer].append({
-				'id': tid,
-				'has_research_grade': (not research_grade_observers.empty),
-				'num_other_observers': 0,
-			})
-		elif research_grade_observers.shape[0] == 1:
-			# Multiple people observed the species, but only one person has research-grade observation(s).
-			rg_observer = research_grade_observers.squeeze()
-			if rg_observer not in unique_observations:
-				unique_observations[rg_observer] = []
-			
-			species.loc[tid, 'uniquely_observed'] = True
+	# Count distinct observers and distinct RG observers per taxon in a single hash-based pass each, rather than
+	# scanning the whole dataframe once per species.
+	observer_counts = df.groupby('taxon_id', sort=False)['user_login'].nunique().reindex(species.index, fill_value=0)
+	rg_observer_counts = rg_df.groupby('taxon_id', sort=False)['user_login'].nunique().reindex(species.index, fill_value=0)
+
+	species.loc[:, 'project_observation_count'] = observer_counts
+
+	# Only one person made any observations of these species.
+	only_one_observer = observer_counts == 1
+	# Multiple people observed these species, but only one person has research-grade observation(s).
+	only_one_rg_observer = (observer_counts > 1) & (rg_observer_counts == 1)
+
+	unique_tids = species.index[only_one_observer | only_one_rg_observer]
+	species.loc[:, 'uniquely_observed'] = only_one_observer | only_one_rg_observer
+
+	# Work out the details of each uniquely observed taxon in one go, looking only at their observations. In both
+	# cases the relevant observer is the (only) RG observer if there is one, otherwise the only observer.
+	unique_df = df.loc[df.loc[:, 'taxon_id'].isin(unique_tids), :]
+	sole_observers = unique_df.drop_duplicates(subset=['taxon_id']).set_index('taxon_id').loc[:, 'user_login'].reindex(unique_tids)
+	sole_rg_observers = rg_df.loc[rg_df.loc[:, 'taxon_id'].isin(unique_tids), :].drop_duplicates(subset=['taxon_id']).set_index('taxon_id').loc[:, 'user_login'].reindex(unique_tids)
+	has_research_grade = rg_observer_counts.loc[unique_tids] > 0
+	unique_taxa = zip(
+		unique_tids,
+		np.where(has_research_grade, sole_rg_observers.to_numpy(), sole_observers.to_numpy()),
+		has_research_grade.tolist(),
+		(observer_counts.loc[unique_tids] - 1).tolist(),
+		species.loc[unique_tids, 'scientific_name'].tolist(),
+	)
+
+	for tid, observer, has_research_grade, num_other_observers, scientific_name in unique_taxa:
+		if observer not in unique_observations:
+			unique_observations[observer] = []
 
-			unique_observations[rg_observer].append({
-				'id': tid,
-				'has_research_grade': True,
-				'num_other_observers': observers.shape[0] - 1,
-			})
+		unique_observations[observer].append({
+			'id': tid,
+			'has_research_grade': has_research_grade,
+			'num_other_observers': num_other_observers,
+			# Stored here so each observer’s taxa can be sorted without looking anything up.
+			'scientific_name': scientific_name,
+		})
 
 	# If we’re looking up notability by place, fetch notability data.
 	if len(places) > 0:
@@ -338,99 +486,138 @@ body {
 		except IndexError:
 			global_p_config = {}
 		
-		potentially_notable_taxon_ids = list(species.loc[species.loc[:, 'project_observation_count'] <= global_p_config.get('observation_threshold', 5), 'taxon_id'].dropna())
+		potentially_notable_taxon_ids = [int(t) for t in species.loc[species.loc[:, 'project_observation_count'] <= global_p_config.get('observation_threshold', 5), 'taxon_id'].dropna()]
 		
 		print(f"Found {len(potentially_notable_taxon_ids)} potentially notable taxa")
+		# Keep the full list around, as potentially_notable_taxon_ids gets whittled down place by place.
+		candidate_taxon_ids = list(potentially_notable_taxon_ids)
 		
 		f_output.write(f"""<h{root_h_lvl+1} id="notable-species">Notable Species</h{root_h_lvl+1}>\n\n""")
 		
-		notability_results = {}
-		for p_config in places:
+		# Only potentially notable taxa can be reported as firsts or notable, so the lookups below only need their observations.
+		notable_df = df.loc[df.loc[:, 'taxon_id'].isin(potentially_notable_taxon_ids), :]
+		notable_rg_df = rg_df.loc[rg_df.loc[:, 'taxon_id'].isin(potentially_notable_taxon_ids), :]
+
+		# Find the earliest observation (and earliest RG observation) of each taxon once up front, for reporting firsts.
+		obs_by_time = notable_df.sort_values('time_observed_at', ascending=True, kind='stable')
+		first_obs_cols = ['id', 'quality_grade', 'image_url_smol', 'user_login']
+		first_any_obs = obs_by_time.drop_duplicates(subset=['taxon_id']).set_index('taxon_id').loc[:, first_obs_cols].to_dict(orient='index')
+		first_rg_obs = notable_rg_df.sort_values('time_observed_at', ascending=True, kind='stable').drop_duplicates(subset=['taxon_id']).set_index('taxon_id').loc[:, first_obs_cols].to_dict(orient='index')
+		# Likewise find everyone who observed each taxon (in order of their first observation of it), and who has RG observations of it.
+		observers_by_taxon = obs_by_time.drop_duplicates(subset=['taxon_id', 'user_login']).groupby('taxon_id', sort=False)['user_login'].agg(list).to_dict()
+		rg_observers_by_taxon = notable_rg_df.groupby('taxon_id', sort=False)['user_login'].agg(set).to_dict()
+		
+		for p_ix, p_config in enumerate(places):
 			p_col = p_config['col']
 			pids = p_config['quoted_pids']
-			notability_results[p_config['col']] = []
-			species.loc[:, f"{p_col}_first"] = False
-			species.loc[:, f"{p_col}_notable"] = False
 
-			# Create place-specific first and notability columns.
 			if p_config['id'] != 'global':
-				# TODO: use each stage to whittle down the list of potentially notable taxon, to reduce the
-				# number of queries required for the larger places.
-				for tids in chunks(potentially_notable_taxon_ids, 100):
-					ctids = urllib.parse.quote_plus(','.join([str(int(t)) for t in tids]))
-					notability_results[p_col].extend(fetch_all_results(f"https://api.inaturalist.org/v1/observations/species_counts?place_id={pids}&taxon_id={ctids}&rank=species&locale={config.get('locale', 'en')}", cache_location='data/_cache'))
-				
-				for nr in notability_results[p_col]:
-					species.loc[nr['taxon']['id'], [f"{p_col}_observation_count", 'global_observation_count', f"common_name_{config.get('locale', 'en')}"]] = [
-						nr['count'],
-						nr['taxon']['observations_count'],
-						nr['taxon'].get('preferred_common_name')
-					]
-				notable_ix = ~pd.isnull(species.loc[:, f"{p_col}_observation_count"])
-				species.loc[notable_ix, f"{p_col}_first"] = species.loc[notable_ix, 'project_observation_count'] == species.loc[notable_ix, f"{p_col}_observation_count"]
-				try:
-					species.loc[notable_ix, f"{p_col}_notable"] = species.loc[notable_ix, f"{p_col}_observation_count"] <= p_config.get('observation_threshold', 5)
-				except Exception as e:
-					print(f"Caught {type(e)}: {e} while trying to determine whether observations of a species were notable.")
-					IPython.embed()
+				species.loc[:, f"{p_col}_observation_count"] = np.nan
+				nr_df = fetch_species_counts(potentially_notable_taxon_ids, filters=f"place_id={pids}", locale=locale, cache=response_cache)
+				nr_df = nr_df.loc[nr_df.index.isin(species.index), :]
+				species.loc[nr_df.index, f"{p_col}_observation_count"] = nr_df.loc[:, 'count']
+				species.loc[nr_df.index, 'global_observation_count'] = nr_df.loc[:, 'global_count']
+				species.loc[nr_df.index, f"common_name_{locale}"] = nr_df.loc[:, 'common_name']
+				place_counts = species.loc[:, f"{p_col}_observation_count"]
+
+				# Use each stage to whittle down the list of potentially notable taxa, to reduce the number of queries
+				# required for the larger places. Counts can only grow as places get bigger, so a taxon observed here
+				# more often than both its project count and every later place’s threshold can be neither first nor
+				# notable in any of them.
+				later_threshold = max([p.get('observation_threshold', 5) for p in places[p_ix+1:]], default=None)
+				if later_threshold is not None:
+					ruled_out = (place_counts > later_threshold) & (place_counts > species.loc[:, 'project_observation_count'])
+					potentially_notable_taxon_ids = [t for t in potentially_notable_taxon_ids if not ruled_out.get(t, False)]
 			else:
-				# No additional data is required for global results, provided they’re processed last.
-				notable_ix = ~pd.isnull(species.loc[:, 'global_observation_count'])
-				species.loc[notable_ix, 'global_first'] = species.loc[notable_ix, 'project_observation_count'] == species.loc[notable_ix, 'global_observation_count']
-				species.loc[notable_ix, 'global_notable'] = species.loc[notable_ix, 'global_observation_count'] <= global_p_config.get('observation_threshold', 5)
+				# Global counts come for free with each smaller place’s results, provided global is processed last. Only
+				# taxa which turned up in none of them (e.g. if no smaller places are configured) need a global query.
+				missing_tids = [t for t in candidate_taxon_ids if pd.isnull(species.at[t, 'global_observation_count'])]
+				if len(missing_tids) > 0:
+					nr_df = fetch_species_counts(missing_tids, locale=locale, cache=response_cache)
+					nr_df = nr_df.loc[nr_df.index.isin(species.index), :]
+					species.loc[nr_df.index, 'global_observation_count'] = nr_df.loc[:, 'global_count']
+					species.loc[nr_df.index, f"common_name_{locale}"] = nr_df.loc[:, 'common_name']
+				place_counts = species.loc[:, 'global_observation_count']
+
+			# Create place-specific first and notability columns.
+			notable_ix = ~pd.isnull(place_counts)
+			try:
+				species = species.assign(**{
+					f"{p_col}_first": notable_ix & (species.loc[:, 'project_observation_count'] == place_counts),
+					f"{p_col}_notable": notable_ix & (place_counts <= p_config.get('observation_threshold', 5)),
+				})
+			except Exception as e:
+				print(f"Caught {type(e)}: {e} while trying to determine whether observations of a species were notable.")
+				if not args.shell:
+					raise
+				# IPython is slow to import, so only load it when it’s actually needed.
+				import IPython
+				IPython.embed()
 
 			# Update general notability
 			species.loc[notable_ix, 'notable'] = species.loc[notable_ix, 'notable'] | species.loc[notable_ix, f"{p_col}_notable"]
 			
-			# Clean up the species dataframe.
-			species = species.loc[~pd.isnull(species.loc[:, 'taxon_id']), :]
-			species.loc[:, 'taxon_id'] = species.loc[:, 'taxon_id'].astype(int)
-
 			f_output.write(f"""<h{root_h_lvl+2} id="{p_col}"><a href="#{p_col}">{html.escape(p_config['name'])}</a></h{root_h_lvl+2}>\n""")
 
 			# Report firsts first (NPI).
-			f_output.write(f"""<h{root_h_lvl+3} id="{p_col}-firsts"><a href="#{p_col}-firsts">First Observations</a> ({species.query(f"{p_col}_first").shape[0]})</h{root_h_lvl+3}>\n""")
+			first_mask = species.loc[:, f"{p_col}_first"].to_numpy(dtype=bool)
+			firsts = species.loc[first_mask, :].sort_values('scientific_name', ascending=True)
+			f_output.write(f"""<h{root_h_lvl+3} id="{p_col}-firsts"><a href="#{p_col}-firsts">First Observations</a> ({firsts.shape[0]})</h{root_h_lvl+3}>\n""")
 			f_output.write(f"""<ul class="observations-container">\n""")
-			for i, tax_row in species.query(f"{p_col}_first").sort_values('scientific_name', ascending=True).iterrows():
+			first_items = []
+			# Plain dicts are much cheaper to iterate over than the Series iterrows builds for every row.
+			for tax_row in firsts.to_dict(orient='records'):
 				tid = tax_row['taxon_id']
-				taxa_url = f"https://inaturalist.org/taxa/{int(tid)}"
 				
-				try:
+				if tid in first_rg_obs:
 					# Look for an RG observation first, and prioritise that.
-					first_obs = df.loc[(df.loc[:, 'taxon_id'] == tid) & df.loc[:, 'quality_grade'] == 'research', :].sort_values('time_observed_at', ascending=True).iloc[0, :]
-				except IndexError:
+					first_obs = first_rg_obs[tid]
+				else:
 					# Fall back to using the first non-RG observation if no RG observations are available.
-					first_obs = df.loc[df.loc[:, 'taxon_id'] == tid, :].sort_values('time_observed_at', ascending=True).iloc[0, :]
+					first_obs = first_any_obs[tid]
 				
-				rg_el = 'b' if first_obs['quality_grade'] == 'research' else 'span'
-				f_output.write(f"""<li class="observation filterable"><a class="name" href="{taxa_url}"><{rg_el}>{species_name(tax_row, locale=locale)}</{rg_el}></a> <a href="https://www.inaturalist.org/observations/{first_obs['id']}"><img class="observation-thumbnail" src="{first_obs['image_url_smol']}" alt="" /> first observation by @{first_obs['user_login']}</a></li>\n""")
+				first_items.append(FIRST_OBSERVATION_TEMPLATE.format(
+					tid=int(tid),
+					rg_el=('b' if first_obs['quality_grade'] == 'research' else 'span'),
+					name=species_name(tax_row, locale=locale),
+					obs_id=first_obs['id'],
+					image_url=first_obs['image_url_smol'],
+					observer=first_obs['user_login'],
+				))
+			f_output.write(''.join(first_items))
 			f_output.write(f"</ul>\n")
 			
 			# Then, report all other notable observations.
-			f_output.write(f"""<h{root_h_lvl+3} id="{p_col}-notable"><a href="#{p_col}-notable">Notable Observations</a> ({species.query(f'{p_col}_notable & not {p_col}_first').shape[0]})</h{root_h_lvl+3}>\n""")
+			notable_mask = species.loc[:, f"{p_col}_notable"].to_numpy(dtype=bool) & ~first_mask
+			notables = species.loc[notable_mask, :].sort_values(f'{p_col}_observation_count', ascending=True)
+			f_output.write(f"""<h{root_h_lvl+3} id="{p_col}-notable"><a href="#{p_col}-notable">Notable Observations</a> ({notables.shape[0]})</h{root_h_lvl+3}>\n""")
 			f_output.write(f"<ul>\n")
-			for i, row in species.query(f'{p_col}_notable & not {p_col}_first').sort_values(f'{p_col}_observation_count', ascending=True).iterrows():
-				obs_url = f"https://www.inaturalist.org/observations?taxon_id={int(row['taxon_id'])}"
+			notable_items = []
+			for row in notables.to_dict(orient='records'):
+				tid = int(row['taxon_id'])
+				obs_url = f"https://www.inaturalist.org/observations?taxon_id={tid}"
 				if p_config['id'] != 'global':
 					obs_url = f"{obs_url}&amp;place_id={pids}"
-				taxa_url = f"https://inaturalist.org/taxa/{int(row['taxon_id'])}"
-				
-				rg_observers = list(df.loc[(df.loc[:, 'taxon_id'] == row['taxon_id']) & (df.loc[:, 'quality_grade'] == 'research'), 'user_login'].drop_duplicates())
 				
+				rg_observers = rg_observers_by_taxon.get(row['taxon_id'], set())
+				name = species_name(row, locale=locale)
 				if len(rg_observers) > 0:
-					f_output.write(f'''<li class="filterable"><a href="{taxa_url}"><b>{species_name(row, locale=locale)}</b></a> observed by: ''')
-				else:
-					f_output.write(f'''<li class="filterable"><a href="{taxa_url}">{species_name(row, locale=locale)}</a> observed by: ''')
-				# Report a list of people who observed this species.
-				observers = list(df.loc[df.loc[:, 'taxon_id'] == row['taxon_id'], :].sort_values('time_observed_at', ascending=True).loc[:, 'user_login'].drop_duplicates())
-				for i, observer in enumerate(observers):
-					if observer in rg_observers:
-						f_output.write(f''' <b><a href="https://www.inaturalist.org/observations?user_id={observer}&taxon_id={int(row['taxon_id'])}&{config['context_query']}">@{observer}</a></b>''')
-					else:
-						f_output.write(f''' <a href="https://www.inaturalist.org/observations?user_id={observer}&taxon_id={int(row['taxon_id'])}&{config['context_query']}">@{observer}</a>''')
-					if i+1 < len(observers):
-						f_output.write(',')  # No comma after the last observer in the list.
-				f_output.write(f''' (<a href="{obs_url}">{int(row[f'{p_col}_observation_count'])} total</a>)</li>\n''')
+					name = f"<b>{name}</b>"
+				
+				# Report a list of people who observed this species, with no comma after the last one.
+				observer_links = []
+				for observer in observers_by_taxon[row['taxon_id']]:
+					link = NOTABLE_OBSERVER_TEMPLATE.format(observer=observer, tid=tid, context_query=config['context_query'])
+					observer_links.append(f" <b>{link}</b>" if observer in rg_observers else f" {link}")
+				
+				notable_items.append(NOTABLE_OBSERVATION_TEMPLATE.format(
+					tid=tid,
+					name=name,
+					observers=','.join(observer_links),
+					obs_url=obs_url,
+					count=int(row[f'{p_col}_observation_count']),
+				))
+			f_output.write(''.join(notable_items))
 			f_output.write(f"</ul>\n")
 
 	# Output unique observation report.
@@ -440,18 +627,29 @@ body {
 
 	f_output.write(f"<p>{sum([len(t) for _, t in sorted_observations])} taxa uniquely observed by {len(sorted_observations)} observers.</p>\n")
 
+	# Plain dict lookups are much faster than species.loc for sorting and reporting each observer’s taxa.
+	species_records = species.to_dict(orient='index')
+
+	# Work out everything which doesn’t vary per taxon once, outside the loop.
+	if config.get('project'):
+		taxa_url_prefix, taxa_url_suffix = 'https://www.inaturalist.org/observations?taxon_id=', f"&amp;{config['context_query']}"
+	else:
+		taxa_url_prefix, taxa_url_suffix = 'https://www.inaturalist.org/taxa/', ''
+	place_columns = [(
+		f"{p_config['col']}_notable",
+		f"{p_config['col']}-notable",
+		f"{p_config['col']}_first",
+		p_config.get('first_text', f"First {p_config['name']} observation!"),
+	) for p_config in places]
+
 	for observer, taxa in sorted_observations:
-		f_output.write(f"""\n\n<div class="filterable"><h{root_h_lvl+2} id="{observer}"><a id="{observer}" href="https://www.inaturalist.org/people/{observer}">@{observer}</a> ({len(taxa)} taxa):</h{root_h_lvl+2}>\n""")
-		f_output.write('<ul>\n')
+		parts = [f"""\n\n<div class="filterable"><h{root_h_lvl+2} id="{observer}"><a id="{observer}" href="https://www.inaturalist.org/people/{observer}">@{observer}</a> ({len(taxa)} taxa):</h{root_h_lvl+2}>\n""", '<ul>\n']
 
-		for tobv in sorted(taxa, key=lambda t: species.loc[t['id']]['scientific_name']):
+		for tobv in sorted(taxa, key=operator.itemgetter('scientific_name')):
 			tid = tobv['id']
-			t = species.loc[tid]
+			t = species_records[tid]
 
-			if config.get('project'):
-				taxa_url = f"https://www.inaturalist.org/observations?taxon_id={int(tid)}&amp;{config['context_query']}"
-			else:
-				taxa_url = f'https://www.inaturalist.org/taxa/{int(tid)}'
+			taxa_url = f"{taxa_url_prefix}{int(tid)}{taxa_url_suffix}"
 			
 			rgb, rge = ('<b>', '</b>') if tobv.get('has_research_grade') else ('', '')
 			others = f" ({tobv.get('num_other_observers', 0)})" if tobv.get('num_other_observers', 0) > 0 else ''
@@ -463,17 +661,20 @@ body {
 				classes.append('notable')
 			
 			highest_ranked_first = None
-			for p_config in places:
-				if t[f"{p_config['col']}_notable"]:
-					classes.append(f"{p_config['col']}-notable")
-				if t[f"{p_config['col']}_first"]:
-					highest_ranked_first = p_config.get('first_text', f"First {p_config['name']} observation!")
+			for notable_col, notable_class, first_col, first_text in place_columns:
+				if t[notable_col]:
+					classes.append(notable_class)
+				if t[first_col]:
+					highest_ranked_first = first_text
 
 			if highest_ranked_first:
 				additional_text = f"{additional_text} • {highest_ranked_first}"
 
-			f_output.write(f"""<li class="filterable {' '.join(classes)}"><a href="{taxa_url}">{rgb}{species_name(t, locale=locale)}{rge}</a>{others}{additional_text}</li>\n""")
-		f_output.write("</ul></div>\n")
+			parts.append(f"""<li class="filterable {' '.join(classes)}"><a href="{taxa_url}">{rgb}{species_name(t, locale=locale)}{rge}</a>{others}{additional_text}</li>\n""")
+		parts.append("</ul></div>\n")
+		f_output.write(''.join(parts))
+	with open(os.path.join('data', args.analysis, 'output', 'current', 'index.html'), 'w', encoding='utf-8') as fp:
+		fp.write(f_output.getvalue())
 	f_output.close()
 
 	print(f"Finished creating report. Writing species.csv…")
@@ -492,4 +693,5 @@ and the species CSV in:
 """)
 
 	if args.shell:
+		import IPython
 		IPython.embed()